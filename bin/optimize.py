@@ -2,7 +2,12 @@
 # -* encoding: utf8 *-
 
 import argparse
+import concurrent.futures
+import hashlib
+import json
+import os
 import regex
+import shutil
 import sys
 import yaml
 
@@ -14,88 +19,260 @@ parser.add_argument('--src-group-vars-yml-path', help='Path to source group vars
 parser.add_argument('--dst-requirements-yml-path', help='Path to destination requirements.yml file, where role definitions will be saved', required=True)
 parser.add_argument('--dst-setup-yml-path', help='Path to destination setup.yml file', required=True)
 parser.add_argument('--dst-group-vars-yml-path', help='Path to destination group vars file', required=True)
+parser.add_argument('--cache-dir-path', help='Path to a directory where processed files are cached. Caching is disabled if not provided', required=False)
 
 args = parser.parse_args()
 
+# Prefer the libyaml-backed loader (much faster), falling back to the pure-Python one if libyaml is unavailable.
+Loader = getattr(yaml, 'CSafeLoader', yaml.SafeLoader)
+
+class RoleDefinitionError(Exception):
+    """Raised when a role definition in requirements.yml is invalid (e.g. missing a name)"""
+
+class RoleBlockError(Exception):
+    """Raised when role-specific blocks in a file are malformed (unknown role names, unbalanced start/end blocks, etc.)"""
+
+def load_top_level_keys(file):
+    # Only the top-level mapping keys are of interest, so we walk the parser's event stream
+    # instead of constructing Python objects for every (potentially large and nested) value.
+    keys = set({})
+    depth = 0
+    next_is_key = True
+    for event in yaml.parse(file, Loader=Loader):
+        if isinstance(event, (yaml.MappingStartEvent, yaml.SequenceStartEvent)):
+            depth += 1
+            continue
+
+        if isinstance(event, (yaml.MappingEndEvent, yaml.SequenceEndEvent)):
+            depth -= 1
+            if depth == 1:
+                # A collection node directly under the top-level mapping has just ended.
+                next_is_key = not next_is_key
+            continue
+
+        if depth == 1 and isinstance(event, (yaml.ScalarEvent, yaml.AliasEvent)):
+            if next_is_key and isinstance(event, yaml.ScalarEvent):
+                if event.value == '<<':
+                    # A merge key pulls in the keys of another (anchored) mapping, which the event stream alone doesn't tell us.
+                    # This is rare, so we simply fall back to loading the whole file and let the loader resolve the merge.
+                    file.seek(0)
+                    return set((yaml.load(file, Loader=Loader) or {}).keys())
+                keys.add(event.value)
+            next_is_key = not next_is_key
+    return keys
+
 def load_combined_variable_names_from_files(vars_yml_file_paths):
     variable_names = set({})
     for vars_path in vars_yml_file_paths:
         with open(vars_path, 'r') as file:
-            yaml_data = yaml.safe_load(file)
-
-            variable_names = variable_names | set(yaml_data.keys())
+            variable_names = variable_names | load_top_level_keys(file)
     return variable_names
 
 def load_yaml_file(path):
     with open(path, 'r') as file:
-        return yaml.safe_load(file)
-
-def is_role_definition_in_use(role_definition, used_variable_names):
-    for variable_name in used_variable_names:
-        if 'activation_prefix' in role_definition:
-            if role_definition['activation_prefix'] == '':
-                # Special value indicating "always activate".
-                # We don't really need this dedicated if, but it's more obvious with it.
-                return True
-            if variable_name.startswith(role_definition['activation_prefix']):
-                return True
+        return yaml.load(file, Loader=Loader)
+
+def is_json_round_trippable(data):
+    # JSON cannot represent some of the types YAML can produce (dates, non-string mapping keys, etc.).
+    # Some of these would make `json.dump()` fail, while others (like integer keys) would silently be converted to strings.
+    if data is None or isinstance(data, (str, bool, int, float)):
+        return True
+    if isinstance(data, list):
+        return all(map(is_json_round_trippable, data))
+    if isinstance(data, dict):
+        return all(isinstance(key, str) and is_json_round_trippable(value) for key, value in data.items())
     return False
 
+def load_yaml_file_cached(path):
+    # Parsing JSON is much faster than parsing YAML, so we keep a JSON copy of the parsed data in the cache directory
+    # and only re-parse the YAML file when it's newer than that copy.
+    if args.cache_dir_path is None:
+        return load_yaml_file(path)
+
+    cache_path = os.path.join(args.cache_dir_path, '{0}.json'.format(os.path.basename(path)))
+    if os.path.isfile(cache_path) and os.path.getmtime(cache_path) >= os.path.getmtime(path):
+        with open(cache_path, 'r') as file:
+            return json.load(file)
+
+    data = load_yaml_file(path)
+
+    if not is_json_round_trippable(data):
+        # Loading a JSON copy would not give us the same data, so we don't cache it (and drop any outdated copy).
+        if os.path.exists(cache_path):
+            os.remove(cache_path)
+        return data
+
+    os.makedirs(args.cache_dir_path, exist_ok=True)
+    # Write to a temporary file first, so that an interrupted run never leaves a partial cache entry behind.
+    cache_tmp_path = '{0}.tmp'.format(cache_path)
+    try:
+        with open(cache_tmp_path, 'w') as file:
+            json.dump(data, file, separators=(',', ':'))
+        os.replace(cache_tmp_path, cache_path)
+    finally:
+        if os.path.exists(cache_tmp_path):
+            os.remove(cache_tmp_path)
+
+    return data
+
+def classify_role_definitions(role_definitions):
+    # Splits role definitions (by index) into ones which are always enabled and ones which are enabled by an activation prefix.
+    # Role definitions without an activation prefix are never enabled, so they're not part of the result.
+    always_enabled_indices = []
+    role_indices_by_prefix = {}
+    for index, role_definition in enumerate(role_definitions):
+        if 'name' not in role_definition:
+            raise RoleDefinitionError('Role definition does not have a name and should be adjusted to have one: {0}'.format(role_definition))
+
+        prefix = role_definition.get('activation_prefix', None)
+        if prefix is None:
+            continue
+        if prefix == '':
+            # Special value indicating "always activate".
+            always_enabled_indices.append(index)
+            continue
+        role_indices_by_prefix.setdefault(prefix, []).append(index)
+    return always_enabled_indices, role_indices_by_prefix
+
+def find_enabled_role_definitions(role_definitions, always_enabled_indices, role_indices_by_prefix, used_variable_names):
+    enabled_indices = set(always_enabled_indices)
+
+    if len(role_indices_by_prefix) != 0 and len(used_variable_names) != 0:
+        # Activation prefixes tend to have only a handful of distinct lengths.
+        # For each such length, we collect the leading characters (of that length) of every variable name,
+        # so that checking whether a role is enabled becomes a simple set lookup.
+        prefixes_by_length = {}
+        for prefix in role_indices_by_prefix.keys():
+            prefixes_by_length.setdefault(len(prefix), []).append(prefix)
+
+        for length, prefixes in prefixes_by_length.items():
+            variable_name_prefixes = {variable_name[:length] for variable_name in used_variable_names if len(variable_name) >= length}
+            for prefix in prefixes:
+                if prefix in variable_name_prefixes:
+                    enabled_indices.update(role_indices_by_prefix[prefix])
+
+    return [role_definition for index, role_definition in enumerate(role_definitions) if index in enabled_indices]
+
 def write_yaml_to_file(definitions, path):
     with open(path, 'w') as file:
         yaml.dump(definitions, file)
 
-def read_file(path):
-    with open(path, 'r') as file:
-        return file.read()
+def read_file_lines(path):
+    # Yields lines lazily as bytes (without their trailing newline), just like `file.read().split(b"\n")` would return them.
+    # Like `split()`, a trailing newline (or an empty file) produces a final empty line.
+    # Lines are not decoded, as only the (rare) role names captured from role-specific markers need to be.
+    # Windows line endings are normalized, like reading the file in text mode would do.
+    with open(path, 'rb') as file:
+        line = b''
+        for line in file:
+            if line.endswith(b'\r\n'):
+                yield line[:-2]
+            elif line.endswith(b'\n'):
+                yield line[:-1]
+            else:
+                yield line
+        if line == b'' or line.endswith(b'\n'):
+            yield b''
+
+class ChunkedFileWriter:
+    """Writes bytes to a file in large chunks via os.write(), bypassing Python's buffered IO layer."""
+
+    def __init__(self, path, chunk_size=64 * 1024):
+        # 0o666 (subject to the umask) is what `open(path, 'w')` would use as well.
+        self.fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o666)
+        self.chunk_size = chunk_size
+        self.pending = []
+        self.pending_size = 0
+
+    def write(self, data):
+        self.pending.append(data)
+        self.pending_size += len(data)
+        if self.pending_size >= self.chunk_size:
+            self.flush()
+
+    def flush(self):
+        data = memoryview(b''.join(self.pending))
+        self.pending = []
+        self.pending_size = 0
+        # os.write() may write fewer bytes than requested, so we loop until everything is written.
+        while len(data) != 0:
+            data = data[os.write(self.fd, data):]
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        try:
+            if exc_type is None:
+                self.flush()
+        finally:
+            os.close(self.fd)
+
+# Matches both the beginning and the end of role-specific blocks.
+# The first group is `/` for block ends and empty for block starts. The second group is the role name.
+# Example (start): `# role-specific:playbook_help`
+# Example (end): `# /role-specific:playbook_help`
+# It operates on bytes, as lines are not decoded (see `read_file_lines`).
+regex_role_specific_block_marker = regex.compile(rb'^\s*#\s*(/?)role-specific:\s*([^\s]+)$')
+
+def process_file_contents(file_name, dst_path, enabled_role_names, known_role_names):
+    # Output is written to a temporary file first and only moved into place once the whole file was processed successfully,
+    # so that errors (like unbalanced role-specific blocks) do not leave a partially-written destination file behind.
+    dst_tmp_path = '{0}.tmp'.format(dst_path)
+    try:
+        with ChunkedFileWriter(dst_tmp_path) as dst_file:
+            write_processed_lines(file_name, dst_file, enabled_role_names, known_role_names)
+        os.replace(dst_tmp_path, dst_path)
+    finally:
+        if os.path.exists(dst_tmp_path):
+            os.remove(dst_tmp_path)
+
+def write_processed_lines(file_name, dst_file, enabled_role_names, known_role_names):
+    # Only used in error messages, but computed once (instead of every time such a message is built).
+    known_role_names_sorted = sorted(known_role_names)
 
-def write_to_file(contents, path):
-    with open(path, 'w') as file:
-        file.write(contents)
-
-# Matches the beginning of role-specific blocks.
-# Example: `# role-specific:playbook_help`
-regex_role_specific_block_start = regex.compile('^\\s*#\\s*role-specific:\\s*([^\\s]+)$')
+    role_specific_stack = []
+    # Number of roles on the stack which are not enabled. Lines are only preserved while this is 0.
+    disabled_roles_in_stack_count = 0
 
-# Matches the end of role-specific blocks.
-# Example: `# /role-specific:playbook_help`
-regex_role_specific_block_end = regex.compile('^\\s*#\\s*/role-specific:\\s*([^\\s]+)$')
+    # Lines are written out as soon as they're found to be preserved, while sequences of blank lines get compacted.
+    # Lines are separated (not terminated) by newlines, so a newline is emitted before every line but the first one.
+    is_first_line = True
+    sequential_blank_lines_count = 0
 
-def process_file_contents(file_name, enabled_role_names, known_role_names):
-    contents = read_file(file_name)
+    # Functions called for every line are bound to local variables once,
+    # so that the loop below uses fast local lookups instead of global and attribute lookups.
+    match_marker = regex_role_specific_block_marker.match
+    intern = sys.intern
+    write = dst_file.write
 
-    lines_preserved = []
-    role_specific_stack = []
+    for line_number, line in enumerate(read_file_lines(file_name), start=1):
+        # The vast majority of lines are not role-specific markers,
+        # so a cheap substring check lets us skip the regular expression for them.
+        marker_matches = match_marker(line) if b'role-specific:' in line else None
+        if marker_matches is not None:
+            is_block_end = marker_matches.group(1) != b''
+            role_name = intern(marker_matches.group(2).decode('utf-8'))
 
-    for line_number, line in enumerate(contents.split("\n")):
-        # Stage 1: looking for a role-specific starting block
-        start_role_matches = regex_role_specific_block_start.match(line)
-        if start_role_matches is not None:
-            role_name = start_role_matches.group(1)
             if role_name not in known_role_names:
-                raise Exception('Found start block for role {0} on line {1} in file {2}, but it is not a known role name found among: {3}'.format(
+                raise RoleBlockError('Found {0} block for role {1} on line {2} in file {3}, but it is not a known role name found among: {4}'.format(
+                    'end' if is_block_end else 'start',
                     role_name,
                     line_number,
                     file_name,
-                    known_role_names,
+                    known_role_names_sorted,
                 ))
-            role_specific_stack.append(role_name)
-            continue
 
-        # Stage 2: looking for role-specific closing blocks
-        end_role_matches = regex_role_specific_block_end.match(line)
-        if end_role_matches is not None:
-            role_name = end_role_matches.group(1)
-            if role_name not in known_role_names:
-                raise Exception('Found end block for role {0} on line {1} in file {2}, but it is not a known role name found among: {3}'.format(
-                    role_name,
-                    line_number,
-                    file_name,
-                    known_role_names,
-                ))
+            # Stage 1: role-specific starting block
+            if not is_block_end:
+                role_specific_stack.append(role_name)
+                if role_name not in enabled_role_names:
+                    disabled_roles_in_stack_count += 1
+                continue
 
+            # Stage 2: role-specific closing block
             if len(role_specific_stack) == 0:
-                raise Exception('Found end block for role {0} on line {1} in file {2}, but there is no opening statement for it'.format(
+                raise RoleBlockError('Found end block for role {0} on line {1} in file {2}, but there is no opening statement for it'.format(
                     role_name,
                     line_number,
                     file_name,
@@ -103,7 +280,7 @@ def process_file_contents(file_name, enabled_role_names, known_role_names):
 
             last_role_name = role_specific_stack[len(role_specific_stack) - 1]
             if role_name != last_role_name:
-                raise Exception('Found end block for role {0} on line {1} in file {2}, but the last starting block was for role {3}'.format(
+                raise RoleBlockError('Found end block for role {0} on line {1} in file {2}, but the last starting block was for role {3}'.format(
                     role_name,
                     line_number,
                     file_name,
@@ -111,56 +288,113 @@ def process_file_contents(file_name, enabled_role_names, known_role_names):
                 ))
 
             role_specific_stack.pop()
+            if last_role_name not in enabled_role_names:
+                disabled_roles_in_stack_count -= 1
 
             continue
 
         # Stage 3: regular line
-        all_roles_allowed = True
-        for role_name in role_specific_stack:
-            if role_name not in enabled_role_names:
-                all_roles_allowed = False
-                break
-
-        if all_roles_allowed:
-            lines_preserved.append(line)
-
-    if len(role_specific_stack) != 0:
-        raise Exception('Expected one or more closing block for role-specific tags in file {0}: {1}'.format(file_name, role_specific_stack))
-
-    lines_final = []
-    sequential_blank_lines_count = 0
-    for line in lines_preserved:
-        if line != "":
-            lines_final.append(line)
-            sequential_blank_lines_count = 0
+        if disabled_roles_in_stack_count != 0:
             continue
 
-        if sequential_blank_lines_count <= 1:
-            lines_final.append(line)
+        # At most 2 sequential blank lines are preserved, so the counter never goes above 2.
+        if line:
+            sequential_blank_lines_count = 0
+        elif sequential_blank_lines_count < 2:
             sequential_blank_lines_count += 1
+        else:
             continue
 
-    return "\n".join(lines_final)
+        if not is_first_line:
+            write(b"\n")
+        write(line)
+        is_first_line = False
+
+    if len(role_specific_stack) != 0:
+        raise RoleBlockError('Expected one or more closing block for role-specific tags in file {0}: {1}'.format(file_name, role_specific_stack))
+
+def get_cache_path_prefix(dst_path):
+    # Cache entries are named after the destination file, so that older entries for it can be found (and evicted).
+    return os.path.join(args.cache_dir_path, '{0}.'.format(os.path.basename(dst_path)))
+
+def get_cache_path(src_path, dst_path, enabled_role_names, known_role_names):
+    # The processed output only depends on the source file contents, on the enabled/known role names
+    # and on this script itself (which may change when the playbook is updated),
+    # so a hash of all of these uniquely identifies it.
+    digest = hashlib.blake2b()
+    with open(__file__, 'rb') as file:
+        digest.update(file.read())
+    digest.update(b'\0\0')
+    with open(src_path, 'rb') as file:
+        digest.update(file.read())
+    digest.update(b'\0\0')
+    digest.update('\0'.join(sorted(enabled_role_names)).encode('utf-8'))
+    digest.update(b'\0\0')
+    digest.update('\0'.join(sorted(known_role_names)).encode('utf-8'))
+    return '{0}{1}.out'.format(get_cache_path_prefix(dst_path), digest.hexdigest())
+
+def remove_other_cache_entries(dst_path, cache_path):
+    # Only the most recent entry is kept for each destination file, so the cache directory doesn't keep growing
+    # with every playbook update or every change to the set of enabled roles.
+    prefix = os.path.basename(get_cache_path_prefix(dst_path))
+    for file_name in os.listdir(args.cache_dir_path):
+        path = os.path.join(args.cache_dir_path, file_name)
+        if file_name.startswith(prefix) and file_name.endswith('.out') and path != cache_path:
+            os.remove(path)
+
+def copy_file_atomically(src_path, dst_path):
+    # Copy to a temporary file first, so that an interrupted copy never leaves a partially-written file behind.
+    dst_tmp_path = '{0}.tmp'.format(dst_path)
+    try:
+        shutil.copyfile(src_path, dst_tmp_path)
+        os.replace(dst_tmp_path, dst_path)
+    finally:
+        if os.path.exists(dst_tmp_path):
+            os.remove(dst_tmp_path)
+
+def process_file(src_path, dst_path, enabled_role_names, known_role_names):
+    if args.cache_dir_path is None:
+        process_file_contents(src_path, dst_path, enabled_role_names, known_role_names)
+        return
+
+    cache_path = get_cache_path(src_path, dst_path, enabled_role_names, known_role_names)
+    if os.path.isfile(cache_path):
+        copy_file_atomically(cache_path, dst_path)
+        return
+
+    process_file_contents(src_path, dst_path, enabled_role_names, known_role_names)
+
+    os.makedirs(args.cache_dir_path, exist_ok=True)
+    copy_file_atomically(dst_path, cache_path)
+    remove_other_cache_entries(dst_path, cache_path)
 
 vars_paths = args.vars_paths.split(' ')
 used_variable_names = load_combined_variable_names_from_files(vars_paths)
 
-all_role_definitions = load_yaml_file(args.src_requirements_yml_path)
+all_role_definitions = load_yaml_file_cached(args.src_requirements_yml_path)
 
-enabled_role_definitions = []
-for role_definition in all_role_definitions:
-    if 'name' not in role_definition:
-        raise Exception('Role definition does not have a name and should be adjusted to have one: {0}'.format(role_definition))
-    if is_role_definition_in_use(role_definition, used_variable_names):
-        enabled_role_definitions.append(role_definition)
+always_enabled_role_indices, role_indices_by_activation_prefix = classify_role_definitions(all_role_definitions)
 
-write_yaml_to_file(enabled_role_definitions, args.dst_requirements_yml_path)
+enabled_role_definitions = find_enabled_role_definitions(
+    all_role_definitions,
+    always_enabled_role_indices,
+    role_indices_by_activation_prefix,
+    used_variable_names,
+)
 
-known_role_names = tuple(map(lambda definition: definition['name'], all_role_definitions))
-enabled_role_names = tuple(map(lambda definition: definition['name'], enabled_role_definitions))
-
-setup_yml_processed = process_file_contents(args.src_setup_yml_path, enabled_role_names, known_role_names)
-write_to_file(setup_yml_processed, args.dst_setup_yml_path)
+write_yaml_to_file(enabled_role_definitions, args.dst_requirements_yml_path)
 
-group_vars_yml_processed = process_file_contents(args.src_group_vars_yml_path, enabled_role_names, known_role_names)
-write_to_file(group_vars_yml_processed, args.dst_group_vars_yml_path)
+# Role names are interned, so that membership checks against names captured from role-specific markers
+# benefit from CPython's fast path for comparing identical string objects.
+known_role_names = frozenset(map(lambda definition: sys.intern(definition['name']), all_role_definitions))
+enabled_role_names = frozenset(map(lambda definition: sys.intern(definition['name']), enabled_role_definitions))
+
+# The two files are independent of each other (each task has its own source and destination files), so they're processed concurrently.
+with concurrent.futures.ThreadPoolExecutor(max_workers=2) as executor:
+    futures = [
+        executor.submit(process_file, args.src_setup_yml_path, args.dst_setup_yml_path, enabled_role_names, known_role_names),
+        executor.submit(process_file, args.src_group_vars_yml_path, args.dst_group_vars_yml_path, enabled_role_names, known_role_names),
+    ]
+    for future in futures:
+        # Re-raises any exception that happened while processing
+        future.result()